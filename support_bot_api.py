@@ -1,13 +1,19 @@
 # support_bot_api.py
 
+import asyncio
+import contextlib
+import logging
+import logging.handlers
 import os
+import queue
+import time
 from typing import List, Optional, Literal
 
 import httpx
-from fastapi import FastAPI, BackgroundTasks
+import orjson
+from fastapi import FastAPI, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from sendgrid import SendGridAPIClient
+from pydantic import BaseModel, ConfigDict
 from sendgrid.helpers.mail import Mail
 
 # ---------- Types / Models ----------
@@ -22,6 +28,8 @@ class SupportBotRequest(BaseModel):
 
 
 class SupportBotReply(BaseModel):
+  model_config = ConfigDict(frozen=True)
+
   role: str = "bot"
   name: str = "Road Workers Connect Support Bot"
   reply: str
@@ -33,9 +41,83 @@ class WelcomeRequest(BaseModel):
   userId: str  # new human user's Supabase user id
 
 
+class WelcomeReply(BaseModel):
+  status: Literal["ok", "error"]
+  message: Optional[str] = None
+
+
 # ---------- App Setup ----------
 
-app = FastAPI(title="Road Workers Connect - Support & Welcome Bot")
+class RawQueueHandler(logging.handlers.QueueHandler):
+  """
+  Enqueue records as-is. The stock prepare() formats the message (and any
+  traceback) on the logging caller; here that is left to the listener thread.
+  Only safe with an in-process queue and immutable log arguments.
+  """
+
+  def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+    return record
+
+
+log = logging.getLogger("support_bot")
+log.setLevel(os.getenv("LOG_LEVEL", "INFO"))
+# Records are only handled by the queue listener started in lifespan, so
+# formatting, traceback rendering and stream writes happen on its thread
+# rather than on the request path.
+log.propagate = False
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+  stream_handler = logging.StreamHandler()
+  stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+  log_queue = queue.SimpleQueue()
+  queue_handler = RawQueueHandler(log_queue)
+  log_listener = logging.handlers.QueueListener(log_queue, stream_handler)
+  log.addHandler(queue_handler)
+  log_listener.start()
+
+  # One pooled Supabase client for the whole process, so welcome DMs reuse
+  # kept-alive connections instead of opening a new TLS session per signup.
+  # HTTP/2 (needs httpx[http2]) multiplexes concurrent calls over one
+  # connection and HPACK-compresses the repeated service-role key headers.
+  app.state.supabase = httpx.AsyncClient(
+    base_url=SUPABASE_REST_URL,
+    http2=True,
+    headers={
+      "apikey": SUPABASE_SERVICE_ROLE_KEY,
+      "Authorization": f"Bearer {SUPABASE_SERVICE_ROLE_KEY}",
+    },
+    limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+    timeout=10,
+  )
+  # SendGrid's v3 API is called directly over httpx so issue emails are sent on
+  # the event loop instead of blocking a threadpool worker in the sync SDK.
+  app.state.sendgrid = httpx.AsyncClient(
+    base_url=SENDGRID_API_URL,
+    headers={"Authorization": f"Bearer {SENDGRID_API_KEY}"},
+    limits=httpx.Limits(max_connections=10, max_keepalive_connections=5),
+    timeout=10,
+  )
+  # Issue reports are queued and sent by a single worker, so a burst of reports
+  # never holds up responses and the backlog is bounded.
+  app.state.email_queue = asyncio.Queue(maxsize=EMAIL_QUEUE_SIZE)
+  email_task = asyncio.create_task(email_worker(app.state.email_queue, app.state.sendgrid))
+  try:
+    yield
+  finally:
+    with contextlib.suppress(asyncio.TimeoutError):
+      await asyncio.wait_for(app.state.email_queue.join(), timeout=EMAIL_DRAIN_TIMEOUT_SECONDS)
+    email_task.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+      await email_task
+    await app.state.sendgrid.aclose()
+    await app.state.supabase.aclose()
+    log_listener.stop()
+    log.removeHandler(queue_handler)
+
+
+app = FastAPI(title="Road Workers Connect - Support & Welcome Bot", lifespan=lifespan)
 
 origins = [
   "https://app.superiorllc.org",
@@ -49,11 +131,18 @@ app.add_middleware(
   allow_credentials=True,
   allow_methods=["POST", "OPTIONS"],
   allow_headers=["*"],
+  # Let browsers reuse preflight results for a day instead of Starlette's 10 min.
+  max_age=86400,
 )
 
 SENDGRID_API_KEY = os.getenv("SENDGRID_API_KEY")
 SUPPORT_FROM_EMAIL = os.getenv("SUPPORT_FROM_EMAIL", "no-reply@superiorllc.org")
 SUPPORT_TO_EMAIL = os.getenv("SUPPORT_TO_EMAIL", "info@superiorllc.org")
+SENDGRID_API_URL = "https://api.sendgrid.com/v3"
+
+EMAIL_QUEUE_SIZE = 1000
+EMAIL_MAX_ATTEMPTS = 4
+EMAIL_DRAIN_TIMEOUT_SECONDS = 10
 
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_SERVICE_ROLE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
@@ -69,176 +158,312 @@ SUPABASE_REST_URL = SUPABASE_URL.rstrip("/") + "/rest/v1"
 
 # ---------- Support Bot Logic ----------
 
+ENVIRONMENT_ISSUE_TRIGGERS = (
+  "not loading",
+  "spinner",
+  "crash",
+  "error",
+  "404",
+  "500",
+  "502",
+  "cannot connect",
+  "connection problem",
+  "network issue",
+  "link not working",
+  "broken link",
+  "app froze",
+  "white screen",
+)
+
+# Triggers past the first few KiB of a pasted stack trace add nothing, so only
+# the head of the message is lowered and scanned.
+ENV_ISSUE_SCAN_LIMIT = 4096
+
+
 def looks_like_environment_issue(message: str) -> bool:
-  lower = message.lower()
-  triggers = [
-    "not loading",
-    "spinner",
-    "crash",
-    "error",
-    "404",
-    "500",
-    "502",
-    "cannot connect",
-    "connection problem",
-    "network issue",
-    "link not working",
-    "broken link",
-    "app froze",
-    "white screen",
-  ]
-  return any(t in lower for t in triggers)
-
-
-def build_jobs_help(message: str) -> SupportBotReply:
+  lower = message[:ENV_ISSUE_SCAN_LIMIT].lower()
+  return any(t in lower for t in ENVIRONMENT_ISSUE_TRIGGERS)
+
+
+# Canned replies are fully static, so build (and validate) them once at import
+# time.
+
+_JOBS_POST_REPLY = SupportBotReply(
+  reply=(
+    "To post a job, tap “Post a Job”, fill in job title, location, pay range, any "
+    "required certifications, and shift details. When you save, your listing appears "
+    "on the Job Board."
+  ),
+  followUpQuestions=[
+    "Do you want help with the job title or description?",
+    "Is this a short call-out or a longer-term position?",
+  ],
+)
+
+_JOBS_EDIT_REPLY = SupportBotReply(
+  reply=(
+    "To edit a job, open your job post, choose “Edit”, adjust the details, and save. "
+    "The Job Board updates automatically."
+  )
+)
+
+_JOBS_DELETE_REPLY = SupportBotReply(
+  reply=(
+    "To remove a job, open the post and choose “Delete”. Once removed, it will no "
+    "longer appear on the Job Board."
+  )
+)
+
+_JOBS_DEFAULT_REPLY = SupportBotReply(
+  reply=(
+    "I can help you create, edit, or remove job posts. Tell me if you’re posting a new "
+    "job, updating one, or taking one down."
+  )
+)
+
+_CLASSIFIEDS_POST_REPLY = SupportBotReply(
+  reply=(
+    "To post an item for sale, tap “New Classified”, add photos, a clear title, "
+    "condition, price, and pickup or delivery details. When you publish, it appears "
+    "in the Classifieds feed."
+  ),
+  followUpQuestions=[
+    "Are you listing tools, PPE, or heavy equipment?",
+    "Do you want advice on pricing or description?",
+  ],
+)
+
+_CLASSIFIEDS_SOLD_REPLY = SupportBotReply(
+  reply=(
+    "To mark an item as sold, open your classified post and tap “Mark as Sold”. "
+    "Other users will see that it is no longer available."
+  )
+)
+
+_CLASSIFIEDS_DEFAULT_REPLY = SupportBotReply(
+  reply=(
+    "I can walk you through posting items for sale, editing listings, or marking them "
+    "as sold. What are you trying to do?"
+  )
+)
+
+
+def encode_reply(reply: SupportBotReply) -> bytes:
+  return orjson.dumps(reply.model_dump())
+
+
+# Canned replies are served as pre-encoded JSON bodies, so the hot path skips
+# response-model validation and serialization entirely.
+
+_JOBS_DEFAULT_BODY = encode_reply(_JOBS_DEFAULT_REPLY)
+_CLASSIFIEDS_DEFAULT_BODY = encode_reply(_CLASSIFIEDS_DEFAULT_REPLY)
+
+_ENV_ISSUE_BODY = encode_reply(SupportBotReply(
+  reply=(
+    "I’m Road Workers Connect Support Bot. It looks like you’re running into a "
+    "technical problem. We’re aware of the problem you’re having and we will address "
+    "it immediately. If it continues, you can also email info@superiorllc.org."
+  ),
+  issueReported=True,
+))
+
+# Sent with a 503 when the issue-email queue is full and the report is dropped.
+_QUEUE_FULL_BODY = encode_reply(SupportBotReply(
+  reply=(
+    "I’m Road Workers Connect Support Bot. It looks like you’re running into a "
+    "technical problem, but we couldn’t file a report for it right now. Please "
+    "email info@superiorllc.org so we can look into it."
+  ),
+  issueReported=False,
+))
+
+_ERROR_BODY = encode_reply(SupportBotReply(
+  reply=(
+    "I’m Road Workers Connect Support Bot. Something went wrong on our side. We’re "
+    "aware of the problem you’re having and we will address it immediately."
+  ),
+  issueReported=True,
+))
+
+
+_JOBS_BODIES = {
+  "post": encode_reply(_JOBS_POST_REPLY),
+  "edit": encode_reply(_JOBS_EDIT_REPLY),
+  "delete": encode_reply(_JOBS_DELETE_REPLY),
+}
+
+_CLASSIFIEDS_BODIES = {
+  "post": encode_reply(_CLASSIFIEDS_POST_REPLY),
+  "sold": encode_reply(_CLASSIFIEDS_SOLD_REPLY),
+}
+
+
+def build_jobs_help(message: str) -> bytes:
   lower = message.lower()
 
   if "post" in lower and "job" in lower:
-    return SupportBotReply(
-      reply=(
-        "To post a job, tap “Post a Job”, fill in job title, location, pay range, any "
-        "required certifications, and shift details. When you save, your listing appears "
-        "on the Job Board."
-      ),
-      followUpQuestions=[
-        "Do you want help with the job title or description?",
-        "Is this a short call-out or a longer-term position?",
-      ],
-    )
+    return _JOBS_BODIES["post"]
 
   if "edit" in lower or "update" in lower:
-    return SupportBotReply(
-      reply=(
-        "To edit a job, open your job post, choose “Edit”, adjust the details, and save. "
-        "The Job Board updates automatically."
-      )
-    )
+    return _JOBS_BODIES["edit"]
 
   if "delete" in lower or "remove" in lower:
-    return SupportBotReply(
-      reply=(
-        "To remove a job, open the post and choose “Delete”. Once removed, it will no "
-        "longer appear on the Job Board."
-      )
-    )
+    return _JOBS_BODIES["delete"]
 
-  return SupportBotReply(
-    reply=(
-      "I can help you create, edit, or remove job posts. Tell me if you’re posting a new "
-      "job, updating one, or taking one down."
-    )
-  )
+  return _JOBS_DEFAULT_BODY
 
 
-def build_classifieds_help(message: str) -> SupportBotReply:
+def build_classifieds_help(message: str) -> bytes:
   lower = message.lower()
 
-  if "post" in lower and any(w in lower for w in ["item", "equipment", "tool", "tools"]):
-    return SupportBotReply(
-      reply=(
-        "To post an item for sale, tap “New Classified”, add photos, a clear title, "
-        "condition, price, and pickup or delivery details. When you publish, it appears "
-        "in the Classifieds feed."
-      ),
-      followUpQuestions=[
-        "Are you listing tools, PPE, or heavy equipment?",
-        "Do you want advice on pricing or description?",
-      ],
-    )
+  if "post" in lower and any(w in lower for w in ("item", "equipment", "tool", "tools")):
+    return _CLASSIFIEDS_BODIES["post"]
 
   if "mark" in lower and "sold" in lower:
-    return SupportBotReply(
-      reply=(
-        "To mark an item as sold, open your classified post and tap “Mark as Sold”. "
-        "Other users will see that it is no longer available."
-      )
-    )
+    return _CLASSIFIEDS_BODIES["sold"]
+
+  return _CLASSIFIEDS_DEFAULT_BODY
+
 
-  return SupportBotReply(
-    reply=(
-      "I can walk you through posting items for sale, editing listings, or marking them "
-      "as sold. What are you trying to do?"
-    )
+# Keys must cover every SupportContext value.
+_BUILDERS = {
+  "jobs": build_jobs_help,
+  "classifieds": build_classifieds_help,
+}
+
+
+_ISSUE_EMAIL_PREFIX = "Support issue reported from Road Workers Connect:\n\nContext: "
+
+
+def build_issue_email_text(req: SupportBotRequest) -> str:
+  return (
+    f"{_ISSUE_EMAIL_PREFIX}{req.context}\n"
+    f"User ID: {req.userId or 'unknown / guest'}\n\n"
+    f"User message:\n{req.message}"
   )
 
 
-def send_issue_email_sync(req: SupportBotRequest) -> None:
-  text_lines = [
-    "Support issue reported from Road Workers Connect:",
-    "",
-    f"Context: {req.context}",
-    f"User ID: {req.userId or 'unknown / guest'}",
-    "",
-    "User message:",
-    req.message,
-  ]
+async def send_issue_email(req: SupportBotRequest, sendgrid: httpx.AsyncClient) -> None:
   message = Mail(
     from_email=SUPPORT_FROM_EMAIL,
     to_emails=SUPPORT_TO_EMAIL,
     subject="[Road Workers Connect] User-reported issue",
-    plain_text_content="\n".join(text_lines),
+    plain_text_content=build_issue_email_text(req),
   )
-  sg = SendGridAPIClient(SENDGRID_API_KEY)
-  sg.send(message)
+  resp = await sendgrid.post("/mail/send", json=message.get())
+  resp.raise_for_status()
 
 
-async def handle_support_message(req: SupportBotRequest, background_tasks: BackgroundTasks) -> SupportBotReply:
-  if looks_like_environment_issue(req.message):
-    background_tasks.add_task(send_issue_email_sync, req)
-    return SupportBotReply(
-      reply=(
-        "I’m Road Workers Connect Support Bot. It looks like you’re running into a "
-        "technical problem. We’re aware of the problem you’re having and we will address "
-        "it immediately. If it continues, you can also email info@superiorllc.org."
-      ),
-      issueReported=True,
-    )
+def is_retryable_email_error(e: Exception) -> bool:
+  if isinstance(e, httpx.TransportError):
+    return True
+  if isinstance(e, httpx.HTTPStatusError):
+    status = e.response.status_code
+    return status == 429 or status >= 500
+  return False
 
-  if req.context == "jobs":
-    return build_jobs_help(req.message)
 
-  return build_classifieds_help(req.message)
+async def email_worker(email_queue: "asyncio.Queue[SupportBotRequest]", sendgrid: httpx.AsyncClient) -> None:
+  """
+  Drain queued issue reports, retrying rate limits and server errors with
+  exponential backoff (1s, 2s, 4s).
+  """
+  while True:
+    req = await email_queue.get()
+    try:
+      for attempt in range(EMAIL_MAX_ATTEMPTS):
+        try:
+          await send_issue_email(req, sendgrid)
+          break
+        except Exception as e:
+          if attempt == EMAIL_MAX_ATTEMPTS - 1 or not is_retryable_email_error(e):
+            raise
+          await asyncio.sleep(2 ** attempt)
+    except Exception:
+      log.exception("[SupportBot] issue email failed")
+    finally:
+      email_queue.task_done()
+
+
+async def handle_support_message(
+  req: SupportBotRequest,
+  email_queue: "asyncio.Queue[SupportBotRequest]",
+) -> Response:
+  # A fresh Response per request: middleware mutates its headers, so only the
+  # body bytes are shared.
+  if looks_like_environment_issue(req.message):
+    try:
+      email_queue.put_nowait(req)
+    except asyncio.QueueFull:
+      log.warning(
+        "[SupportBot] issue email queue full, dropping report (context=%s, user=%s)",
+        req.context,
+        req.userId or "unknown / guest",
+      )
+      return Response(content=_QUEUE_FULL_BODY, status_code=503, media_type="application/json")
+    return Response(content=_ENV_ISSUE_BODY, media_type="application/json")
+
+  return Response(content=_BUILDERS[req.context](req.message), media_type="application/json")
 
 
 @app.post("/support-bot", response_model=SupportBotReply)
-async def support_bot_endpoint(req: SupportBotRequest, background_tasks: BackgroundTasks):
+async def support_bot_endpoint(req: SupportBotRequest, request: Request):
   try:
-    return await handle_support_message(req, background_tasks)
-  except Exception as e:
-    print("[SupportBot] error:", repr(e))
-    return SupportBotReply(
-      reply=(
-        "I’m Road Workers Connect Support Bot. Something went wrong on our side. We’re "
-        "aware of the problem you’re having and we will address it immediately."
-      ),
-      issueReported=True,
-    )
+    return await handle_support_message(req, request.app.state.email_queue)
+  except Exception:
+    log.exception("[SupportBot] error")
+    return Response(content=_ERROR_BODY, media_type="application/json")
 
 
 # ---------- Moderator Welcome DM Logic ----------
 
+MODERATOR_ID_TTL_SECONDS = 3600.0
+
+_MOD_QUERY_PARAMS = {
+  "is_bot": "eq.true",
+  "bot_role": "eq.moderator",
+  "select": "id",
+  "limit": 1,
+}
+
+# Ask PostgREST for a single object instead of a one-element array; it answers
+# 406 when no row matches.
+_SINGLE_OBJECT_HEADERS = {"Accept": "application/vnd.pgrst.object+json"}
+
+_MOD_ID_CACHE = {"id": None, "exp": 0.0}
+_MOD_ID_LOCK = asyncio.Lock()
+
+
 async def get_moderator_bot_id(client: httpx.AsyncClient) -> Optional[str]:
+  """
+  Return the moderator bot's user id, cached in-process for an hour.
+  A missing moderator is not cached, so a newly created bot is picked up
+  on the next call.
+  """
+  if time.monotonic() < _MOD_ID_CACHE["exp"]:
+    return _MOD_ID_CACHE["id"]
+
+  async with _MOD_ID_LOCK:
+    # Another task may have refreshed the cache while we waited on the lock.
+    if time.monotonic() < _MOD_ID_CACHE["exp"]:
+      return _MOD_ID_CACHE["id"]
+
+    moderator_id = await fetch_moderator_bot_id(client)
+    if moderator_id:
+      _MOD_ID_CACHE["id"] = moderator_id
+      _MOD_ID_CACHE["exp"] = time.monotonic() + MODERATOR_ID_TTL_SECONDS
+    return moderator_id
+
+
+async def fetch_moderator_bot_id(client: httpx.AsyncClient) -> Optional[str]:
   """
   Look up the moderator bot from public.users via Supabase REST.
   """
-  url = f"{SUPABASE_REST_URL}/users"
-  params = {
-    "is_bot": "eq.true",
-    "bot_role": "eq.moderator",
-    "select": "id",
-    "limit": 1,
-  }
-  headers = {
-    "apikey": SUPABASE_SERVICE_ROLE_KEY,
-    "Authorization": f"Bearer {SUPABASE_SERVICE_ROLE_KEY}",
-  }
-
-  resp = await client.get(url, params=params, headers=headers, timeout=10)
-  resp.raise_for_status()
-  data = resp.json()
-  if not data:
+  resp = await client.get("/users", params=_MOD_QUERY_PARAMS, headers=_SINGLE_OBJECT_HEADERS)
+  if resp.status_code == 406:
     return None
-  return data[0]["id"]
+  resp.raise_for_status()
+  return resp.json()["id"]
 
 
 def build_welcome_message_text() -> str:
@@ -252,45 +477,60 @@ def build_welcome_message_text() -> str:
   )
 
 
+_WELCOME_TEXT = build_welcome_message_text()
+
+_WELCOME_DM_HEADERS = {
+  "Content-Type": "application/json",
+  "Prefer": "return=minimal",
+}
+
+
 async def send_welcome_dm(new_user_id: str, client: httpx.AsyncClient) -> None:
   moderator_id = await get_moderator_bot_id(client)
   if not moderator_id:
-    print("[WelcomeBot] No moderator bot found (is_bot = true, bot_role = 'moderator')")
+    log.warning("[WelcomeBot] No moderator bot found (is_bot = true, bot_role = 'moderator')")
     return
 
-  url = f"{SUPABASE_REST_URL}/messages"
-  headers = {
-    "apikey": SUPABASE_SERVICE_ROLE_KEY,
-    "Authorization": f"Bearer {SUPABASE_SERVICE_ROLE_KEY}",
-    "Content-Type": "application/json",
-    "Prefer": "return=minimal",
-  }
-  payload = {
+  payload = orjson.dumps({
     "sender_id": moderator_id,
     "recipient_id": new_user_id,
-    "content": build_welcome_message_text(),
+    "content": _WELCOME_TEXT,
     "is_bot_generated": True,
-  }
+  })
 
-  resp = await client.post(url, headers=headers, json=payload, timeout=10)
+  resp = await client.post("/messages", headers=_WELCOME_DM_HEADERS, content=payload)
   resp.raise_for_status()
-  print(f"[WelcomeBot] Welcome DM inserted for user {new_user_id}")
+  log.info("[WelcomeBot] Welcome DM inserted for user %s", new_user_id)
 
 
-@app.post("/welcome-message")
-async def welcome_message_endpoint(req: WelcomeRequest):
+@app.post("/welcome-message", response_model=WelcomeReply, response_model_exclude_none=True)
+async def welcome_message_endpoint(req: WelcomeRequest, request: Request):
   """
   Call this after a new Supabase user is created.
   Sends a DM from the moderator bot to the new user.
   """
   if not req.userId:
-    return {"status": "error", "message": "userId is required"}
+    return WelcomeReply(status="error", message="userId is required")
 
   try:
-    async with httpx.AsyncClient() as client:
-      await send_welcome_dm(req.userId, client)
-    return {"status": "ok"}
-  except Exception as e:
-    print("[WelcomeBot] error:", repr(e))
+    await send_welcome_dm(req.userId, request.app.state.supabase)
+    return WelcomeReply(status="ok")
+  except Exception:
+    log.exception("[WelcomeBot] error")
     # Do not block signup flow; just log
-    return {"status": "error", "message": "failed to send welcome message"}
+    return WelcomeReply(status="error", message="failed to send welcome message")
+
+
+if __name__ == "__main__":
+  import uvicorn
+
+  # Requires uvicorn[standard]; pinned so a missing uvloop/httptools fails at
+  # startup instead of silently falling back to the pure-Python loop/parser.
+  uvicorn.run(
+    "support_bot_api:app",
+    host=os.getenv("HOST", "0.0.0.0"),
+    port=int(os.getenv("PORT", "8000")),
+    workers=int(os.getenv("WEB_CONCURRENCY", "1")),
+    loop="uvloop",
+    http="httptools",
+  )